@@ -1,5 +1,6 @@
-from typing import List, Set, Any, Optional as Opt, cast
+from typing import List, Set, Any, Optional as Opt
 from collections import defaultdict, UserString
+import asyncio
 import json
 import time
 import os
@@ -7,7 +8,7 @@ import inspect
 import logging
 import pytest
 import whispr
-from whispr import Message, bidict, SERVER_NUMBER
+from whispr import Message, SERVER_NUMBER
 
 
 class OutgoingMessage(UserString):  # pylint: disable=too-many-ancestors
@@ -22,27 +23,48 @@ class OutgoingMessage(UserString):  # pylint: disable=too-many-ancestors
 class FakePipe:
     def __init__(self, mock_signal: "MockSignalProc") -> None:
         self.mock_signal = mock_signal
+        self.draining = False
 
     def write(self, b: bytes) -> None:
-        signal_command = json.loads(b.decode("utf-8").strip())
-        self.mock_signal.outbox.append(OutgoingMessage(signal_command))
-
-    def flush(self) -> None:
-        pass
-
-    def readline(self) -> bytes:
+        self.mock_signal.writes += 1
+        for line in b.decode("utf-8").splitlines():
+            signal_command = json.loads(line)
+            self.mock_signal.outbox.append(OutgoingMessage(signal_command))
+
+    async def drain(self) -> None:
+        # asyncio before 3.10 asserts that only one drain waits at a time
+        assert not self.draining, "concurrent drain"
+        self.draining = True
+        await asyncio.sleep(0)
+        self.draining = False
+
+    async def read(self, n: int) -> bytes:
+        await asyncio.sleep(0)  # let handler tasks run, like a real pipe would
         if self.mock_signal.inbox:
-            return self.mock_signal.inbox.pop(0).encode("utf-8")
+            return self.mock_signal.inbox.pop(0).encode("utf-8")[:n]
         raise Exception("nothing to read")
 
 
+class FakeStderr:
+    def __init__(self) -> None:
+        self.lines: List[bytes] = []
+
+    async def readline(self) -> bytes:
+        if self.lines:
+            return self.lines.pop(0)
+        return b""
+
+
 class MockSignalProc:
     def __init__(self, *args: Any, **kwargs: Any) -> None:
         del args, kwargs
         self.outbox: List[OutgoingMessage] = []
         self.inbox: List[str] = []
+        self.returncode: Opt[int] = None
+        self.writes = 0
         self.stdout = FakePipe(self)
         self.stdin = FakePipe(self)
+        self.stderr = FakeStderr()
 
     def kill(self) -> None:
         pass
@@ -66,22 +88,29 @@ def make_envelope(
 
 class MockWhisperer(whispr.Whisperer):
     def __init__(self, fname: str = "mock_users.json", empty: bool = False):
-        whispr.Whisperer.Popen = MockSignalProc  # type: ignore
         super().__init__(fname)
+        self.signal_proc = MockSignalProc()  # type: ignore
         self.__enter__()
         if empty:  # should load mock_users.json
-            self.user_names = cast(bidict, {})  # fuck pylint/mypy
-            self.user_names = bidict()
-            self.followers = defaultdict(list)
+            self.user_names = {}
+            self.user_numbers = {}
+            self.followers = defaultdict(set)
+            self.following = defaultdict(set)
         self.blocked: Set[str] = set()
 
+    async def start_signal_cli(self) -> None:
+        pass
+
     def run_with_input(self, events: List[str]) -> None:
         assert isinstance(self.signal_proc, MockSignalProc)
-        self.signal_proc.inbox = events
-        self.run()
+        self.signal_proc.inbox = [
+            event + "\n" if event else "" for event in events
+        ]
+        asyncio.run(self.run())
 
     def take_outbox_for(self, number: str) -> List[OutgoingMessage]:
         assert isinstance(self.signal_proc, MockSignalProc)
+        self.flush_sends()
         taken, kept = [], []
         for msg in self.signal_proc.outbox:
             if msg.recipient == number:
@@ -169,9 +198,10 @@ def test_run(caplog: Any) -> None:
         json.dumps({"envelope": make_envelope(source, message)})
         for source, message in inputs
     ] + [
-        "spam",
-        "{",
-        json.dumps({"envelope": {}}),
+        "spam",  # not json, but can't be a message either, so it's skipped
+        '{"envelope": {"dataMessage"',
+        json.dumps({"envelope": {}}),  # receipts and such are skipped quietly
+        json.dumps({"envelope": {"source": bob, "dataMessage": {"ts": 1}}}),
     ]
     reactvelope = make_envelope(
         bob,
@@ -185,8 +215,9 @@ def test_run(caplog: Any) -> None:
         [{alice: "alice", bob: "bob"}, {alice: [bob]}, [nancy]],
         open("testing_users.json", "w"),
     )
+    wisp.signal_proc.stderr.lines.append(b"spam")  # type: ignore
     with wisp:
-        assert wisp.followers[alice] == [bob]
+        assert wisp.followers[alice] == {bob}
         with pytest.raises(Exception, match="nothing to read"):
             wisp.run_with_input(inbox)
         assert wisp.take_outbox_for(carol) == [
@@ -212,8 +243,127 @@ def test_run(caplog: Any) -> None:
     os.remove("testing_users.json")
 
 
+def test_run_until_eof(caplog: Any) -> None:
+    caplog.set_level(logging.WARNING)
+    wisp = MockWhisperer()
+    envelope = make_envelope(alice, "/echo spam")
+    wisp.run_with_input([json.dumps({"envelope": envelope}), ""])
+    assert wisp.take_outbox_for(alice) == ["spam"]
+    assert [rec.message for rec in caplog.records] == [
+        "signal-cli closed stdout"
+    ]
+
+
+def test_run_burst() -> None:
+    wisp = MockWhisperer()
+    # both arrive in one read, so both are read before either is handled.
+    # the second has to be parsed as the answer to the name prompt
+    burst = "\n".join(
+        json.dumps({"envelope": make_envelope(nancy, text)})
+        for text in ("hi", "nan")
+    )
+    wisp.run_with_input([burst, ""])
+    assert wisp.user_names[nancy] == "nan"
+    assert wisp.take_outbox_for(nancy)[-1] == (
+        "other users will now see you as nan"
+    )
+
+
+def test_log_stderr(caplog: Any) -> None:
+    wisp = MockWhisperer()
+    assert isinstance(wisp.signal_proc, MockSignalProc)
+    # a line that isn't utf-8 mustn't stop stderr from being drained
+    wisp.signal_proc.stderr.lines = [b"\xff\xfe", b"still here"]
+    asyncio.run(wisp.log_stderr())
+    assert caplog.messages == [
+        "signal-cli says: \ufffd\ufffd",
+        "signal-cli says: still here",
+    ]
+
+
+def test_read_lines() -> None:
+    wisp = MockWhisperer()
+    assert isinstance(wisp.signal_proc, MockSignalProc)
+    # reads don't line up with lines: several can come at once, or be split
+    wisp.signal_proc.inbox = ["one\ntw", "o\n\nthr", "ee", ""]
+
+    async def read_all() -> List[bytes]:
+        return [line async for line in wisp.read_lines()]
+
+    assert asyncio.run(read_all()) == [b"one", b"two", b"three"]
+
+
+def test_handle_coalesces_writes() -> None:
+    wisp = MockWhisperer()
+
+    async def handle_burst() -> None:
+        wisp.write_lock = asyncio.Lock()  # normally made by run
+        slots = asyncio.Semaphore(2)
+        envelopes = [make_envelope(s, "/echo hi") for s in (alice, bob)]
+        for _ in envelopes:
+            await slots.acquire()
+        await asyncio.gather(
+            *(wisp.handle(envelope, slots) for envelope in envelopes)
+        )
+
+    asyncio.run(handle_burst())
+    assert isinstance(wisp.signal_proc, MockSignalProc)
+    assert wisp.signal_proc.writes == 1
+    assert wisp.take_outbox_for(alice) == wisp.take_outbox_for(bob) == ["hi"]
+
+
+def test_checkpoint() -> None:
+    wisp = MockWhisperer("checkpoint_users.json")
+    wisp.checkpoint_interval = 0
+    wisp.check_in_out(
+        alice, "/name alicia", "other users will now see you as alicia"
+    )
+    assert wisp.dirty
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(asyncio.wait_for(wisp.checkpoint(), 0.1))
+    assert not wisp.dirty
+    assert json.load(open("checkpoint_users.json"))[0][alice] == "alicia"
+    os.remove("checkpoint_users.json")
+
+
+def test_checkpoint_failure(caplog: Any, monkeypatch: Any) -> None:
+    wisp = MockWhisperer("checkpoint_users.json")
+    wisp.checkpoint_interval = 0
+    wisp.dirty = True
+    failures = []
+
+    def full_disk(data: bytes) -> None:
+        failures.append(data)
+        raise OSError("no space left on device")
+
+    monkeypatch.setattr(wisp, "save_user_data", full_disk)
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(asyncio.wait_for(wisp.checkpoint(), 0.1))
+    # still unsaved, and it kept trying instead of dying on the first error
+    assert wisp.dirty
+    assert len(failures) > 1
+    assert "couldn't checkpoint user data" in caplog.messages
+
+
 def test_echo(wisp: MockWhisperer) -> None:
     wisp.check_in_out(alice, "/echo spam", "spam")
+    wisp.check_in_out(alice, "/echo spam  and\neggs", "spam  and\neggs")
+    wisp.check_in_out(
+        alice, "/name", "missing name argument. usage: /name [name]"
+    )
+
+
+def test_message_args(wisp: MockWhisperer) -> None:
+    msg = Message(wisp, make_envelope(alice, "/follow bob now"))
+    assert (msg.command, msg.arg1, msg.tokens) == (
+        "follow",
+        "bob",
+        ["bob", "now"],
+    )
+    msg = Message(wisp, make_envelope(alice, "/help"))
+    assert (msg.command, msg.arg1, msg.tokens) == ("help", None, [])
+    msg = Message(wisp, make_envelope(alice, "just posting"))
+    assert (msg.command, msg.arg1, msg.tokens) == (None, None, None)
 
 
 def test_stop_start() -> None:
@@ -246,6 +396,18 @@ def test_new_user() -> None:
         "'alice' is already taken, use /name to set a different name",
     )
     assert wisp.user_names[nancy] == "nancy"
+    wisp.check_in_out(nancy, "/name nan", "other users will now see you as nan")
+    # leatrice would get their number as a name when they join
+    wisp.check_in_out(
+        nancy,
+        f"/name {leatrice}",
+        f"'{leatrice}' is already taken, use /name to set a different name",
+    )
+    with pytest.raises(ValueError):
+        wisp.set_name(leatrice, "nan")
+    assert wisp.user_numbers == {
+        name: number for number, name in wisp.user_names.items()
+    }
 
 
 def test_follow() -> None:
@@ -277,12 +439,14 @@ def test_invite_unfollow() -> None:
         "text (y)es or (n)o to accept"
     ]
     wisp.check_in_out(leatrice, "yes", "followed alice")
+    wisp.check_in_out(leatrice, "/following", "alice")
     wisp.check_in_out(
         alice, f"/invite {leatrice}", f"you're already following {leatrice}"
     )
 
     wisp.check_in_out(leatrice, f"/unfollow {alice}", f"unfollowed {alice}")
     wisp.check_in_out(leatrice, "/unfollow alice", "you aren't following alice")
+    wisp.check_in_out(leatrice, "/following", "you aren't following anyone")
 
     wisp.check_in_out(bob, "/invite leatrice", "invited leatrice")
     wisp.check_in_out(alice, "/invite leatrice", "invited leatrice")
@@ -300,10 +464,20 @@ def test_invite_unfollow() -> None:
         f"not following alice by default. if you do want to "
         f"follow them, text `/follow {alice}` or `/follow alice`",
     )
+    wisp.check_in_out(bob, "/invite leatrice", "invited leatrice")
+    assert wisp.take_outbox_for(leatrice)
+    # used to match as a substring of "yes"
+    wisp.input(leatrice, "es")
+    assert wisp.take_outbox_for(leatrice)[0].startswith(
+        "that didn't look like a response"
+    )
 
 
 def test_default(wisp: MockWhisperer) -> None:
     wisp.input(alice, posts[0])
+    wisp.flush_sends()
+    assert isinstance(wisp.signal_proc, MockSignalProc)
+    assert wisp.signal_proc.writes == 1  # one write for every follower
     assert (
         wisp.take_outbox_for(bob)
         == wisp.take_outbox_for(carol)
@@ -318,6 +492,11 @@ def test_default(wisp: MockWhisperer) -> None:
     assert wisp.take_outbox_for(yoric)[0].attachments == [
         str(wisp.attachments_dir / attachment) for attachment in attachments
     ]
+    # attachments without any text still get sent along
+    wisp.input(xeres, None, attachments[:1])
+    assert wisp.take_outbox_for(yoric)[0].attachments == [
+        str(wisp.attachments_dir / attachments[0])
+    ]
 
 
 def test_help(wisp: MockWhisperer) -> None:
@@ -333,14 +512,14 @@ def test_help(wisp: MockWhisperer) -> None:
     ]
     wisp.check_in_out(alice, "/hlep", "no such command 'hlep'")
     wisp.check_in_out(alice, "/help hlep", "no such command 'hlep'")
-    wisp.do_foo = lambda event: "fake"  # type: ignore
+    wisp.commands["foo"] = lambda event: "fake"
     wisp.check_in_out(alice, "/help foo", "foo isn't documented, sorry :(")
 
 
 def test_softblock() -> None:
     wisp = MockWhisperer()
-    wisp.followers[alice].append(goofus)
-    wisp.followers[goofus].append(alice)
+    wisp.add_follower(alice, goofus)
+    wisp.add_follower(goofus, alice)
     # https://twitter.com/chordbug/status/1324853505245544454
     post1 = (
         "reply to this whisper with the name of a typeface that doesn't exist"
@@ -366,7 +545,7 @@ def test_proxy() -> None:
     wisp.check_in_out(
         alice, "/proxy", "you must be an admin to use this command"
     )
-    wisp.admins.append(alice)
+    wisp.admins = frozenset([alice])
     wisp.check_in_out(alice, "/proxy", "entered proxy mode")
     wisp.check_in_out(alice, other_server + ":/echo spam", "sent")
     assert wisp.take_outbox_for(other_server) == ["/echo spam"]
@@ -379,12 +558,23 @@ def test_proxy() -> None:
     wisp.check_in_out(alice, "/echo hi", "hi")
 
 
+def test_debug() -> None:
+    wisp = MockWhisperer()
+    wisp.admins = frozenset([alice])
+    wisp.check_in_out(alice, "/debug msg.sender_name", "alice")
+    wisp.check_in_out(alice, "/debug len(self.blocked)", "0")
+    wisp.check_in_out(alice, "/debug )", "unmatched ')' (<debug>, line 1)")
+
+
 def test_reaction() -> None:
+    assert len(whispr.FIB) == 21 and max(whispr.FIB) == 10946  # 1 is there twice
     wisp = MockWhisperer()
-    wisp.followers[alice].extend([xeres, yoric, zoe])
+    for follower in (xeres, yoric, zoe):
+        wisp.add_follower(alice, follower)
     ts = wisp.input(alice, posts[2])
     wisp.input_reaction(bob, emoji=":)", ts=ts)
     wisp.input_reaction(bob, emoji=":)", ts=-1)
+    wisp.input_reaction(leatrice, emoji=":o", ts=ts)  # wasn't sent it
     assert wisp.take_outbox_for(alice) == [f"reactions to '{posts[2]}': bob: :)"]
     wisp.input_reaction(carol, emoji=":(", ts=ts)
     assert wisp.take_outbox_for(alice) == [
@@ -396,6 +586,14 @@ def test_reaction() -> None:
     assert wisp.take_outbox_for(alice) == []
 
 
+def test_bounded_ts_map(wisp: MockWhisperer) -> None:
+    messages = whispr.BoundedTsMap(2)
+    for ts in range(3):
+        messages[ts][alice] = Message(wisp, make_envelope(alice, posts[ts]))
+    assert list(messages) == [1, 2]
+    assert messages[2][alice].text == posts[2]
+
+
 def test_silly_error() -> None:
     wisp = MockWhisperer()
     with pytest.raises(NotImplementedError):
@@ -6,68 +6,126 @@ from typing import (
     Set,
     List,
     Callable,
-    cast,
+    Iterable,
+    Iterator,
+    AsyncIterator,
+    OrderedDict,
 )
 from collections import defaultdict
 from textwrap import dedent
-from subprocess import Popen, PIPE
-from functools import wraps
+from types import CodeType
+from asyncio.subprocess import PIPE
+from functools import wraps, lru_cache, cached_property
+import asyncio
 import pathlib
-import json
+import re
+import sys
+import os
 import time
 import logging
-from bidict import bidict
 import phonenumbers as pn
+import orjson
 
-SERVER_NUMBER = open("server_number").read().strip()
+SERVER_NUMBER = sys.intern(pathlib.Path("server_number").read_text().strip())
 SIGNAL_CLI = f"./signal-cli-script -u {SERVER_NUMBER} daemon --json".split()
+# matched against whole messages, without lowercasing them first
+COMPLIANCE_KEYWORDS = re.compile("stop|block|start|unblock", re.I | re.A)
+# sent when a command blows up
+OOPSIE = (
+    "OOPSIE WOOPSIE!! Uwu We made a fucky wucky!!"
+    "A wittle fucko boingo! The code monkeys at our headquarters "
+    "are working VEWY HAWD to fix this!"
+    # source: https://knowyourmeme.com/memes/oopsie-woopsie
+)
+# accepted replies to an invite
+YES = frozenset(("y", "yes"))
+NO = frozenset(("n", "no"))
 
 logging.basicConfig(
     level=logging.DEBUG, format="{levelname}: {message}", style="{"
 )
 
+# on performance: whispr spends its time waiting on the signal-cli pipe,
+# parsing and encoding json, and doing small dict and string operations per
+# message. there's no numeric inner loop, so JIT compilers like numba have
+# nothing to speed up. look at the pipe I/O (batching writes, see
+# flush_sends), json (orjson) and per-message allocations instead. if a
+# numeric kernel does show up, import numba inside a try so that it stays
+# optional and startup stays cheap
+
 
 class Reaction:
+    __slots__ = ("emoji", "author", "ts")
+
     def __init__(self, reaction: dict) -> None:
-        assert reaction
         self.emoji = reaction["emoji"]
-        self.author = reaction["targetAuthor"]
-        self.ts = round(reaction["targetTimestamp"] / 1000)
+        self.author = sys.intern(reaction["targetAuthor"])
+        self.ts = reaction["targetTimestamp"] // 1000
 
 
 class Message:
     """parses signal-cli output"""
 
+    # one is made for every envelope and hundreds are kept around, so skip the
+    # per-instance __dict__
+    __slots__ = (
+        "sender",
+        "sender_name",
+        "ts",
+        "full_text",
+        "text",
+        "reaction",
+        "attachments",
+        "reactions",
+        "command",
+        "arg1",
+    )
+
     def __init__(self, wisp: "WhispererBase", envelope: dict) -> None:
         msg = envelope.get("dataMessage")
         if not msg:
             raise KeyError
-        if not any(msg.get(k) for k in ("message", "reaction", "attachment")):
+        text = msg.get("message") or ""
+        reaction = msg.get("reaction")
+        attachments = msg.get("attachments")
+        if not (text or reaction or attachments):
             raise KeyError
-        self.sender: str = envelope["source"]
+        # interned so the many lookups keyed on it can use identity checks
+        self.sender: str = sys.intern(envelope["source"])
         self.sender_name = wisp.user_names.get(self.sender, self.sender)
-        self.ts = round(msg["timestamp"] / 1000)
-        self.full_text = self.text = msg.get("message", "")
-        try:
-            self.reaction: Optional[Reaction] = Reaction(msg.get("reaction"))
-        except (AssertionError, KeyError):
-            self.reaction = None
-        self.attachments = [
-            str(wisp.attachments_dir / attachment["id"])
-            for attachment in msg.get("attachments", [])
-        ]
+        self.ts = msg["timestamp"] // 1000
+        self.full_text = self.text = text
+        self.reaction = Reaction(reaction) if reaction else None
+        # most messages are plain text, don't build anything for them
+        self.attachments = (
+            [
+                wisp.attachments_prefix + attachment["id"]
+                for attachment in attachments
+            ]
+            if attachments
+            else []
+        )
 
         self.reactions: Dict[str, str] = {}
         self.command: Optional[str] = None
-        self.tokens: Optional[List[str]] = None
+        self.arg1: Optional[str] = None
+        # handlers mostly only want arg1, so only split that off
         if self.sender in wisp.user_callbacks:
-            self.tokens = self.text.split(" ")
+            self.arg1 = self.text.partition(" ")[0]
         elif self.text and self.text.startswith("/"):
-            command, *self.tokens = self.text.split(" ")
-            self.command = command[1:]  # remove /
-            self.text = " ".join(self.tokens)
+            self.command, _, self.text = self.text[1:].partition(" ")
+            if self.text:
+                self.arg1 = self.text.partition(" ")[0]
 
-        self.arg1 = self.tokens[0] if self.tokens else None
+    @property
+    def tokens(self) -> Optional[List[str]]:
+        """
+        every argument. empty for a command without any, None if this isn't a
+        command or a callback response
+        """
+        if self.arg1 is not None:
+            return self.text.split(" ")
+        return [] if self.command is not None else None
 
     def __repr__(self) -> str:
         return f"<{self.sender_name}: {self.full_text}>"
@@ -76,7 +134,42 @@ class Message:
 Callback = Callable[[Message], Optional[str]]
 
 
-class WhispererBase:
+class BoundedTsMap(OrderedDict[int, Dict[str, Message]]):
+    """
+    messages[timestamp][user] = msg, like a defaultdict(dict), except that
+    once there are more than maxlen timestamps the oldest ones are forgotten
+    """
+
+    def __init__(self, maxlen: int) -> None:
+        super().__init__()
+        self.maxlen = maxlen
+
+    def __missing__(self, ts: int) -> Dict[str, Message]:
+        messages: Dict[str, Message] = {}
+        self[ts] = messages
+        return messages
+
+    def __setitem__(self, ts: int, messages: Dict[str, Message]) -> None:
+        super().__setitem__(ts, messages)
+        self.move_to_end(ts)
+        if len(self) > self.maxlen:
+            self.popitem(last=False)
+
+
+def fibonacci_numbers(count: int) -> Iterator[int]:
+    a, b = 0, 1
+    for _ in range(count):
+        yield a
+        a, b = b, a + b
+
+
+# reaction counts that get the author notified, up to 10946
+FIB = frozenset(fibonacci_numbers(22))
+
+
+# user data, message history, the command tables and the signal-cli plumbing
+# are all state of the one bot, and splitting them up would only add hops
+class WhispererBase:  # pylint: disable=too-many-instance-attributes
     """
     handles communicating with signal-cli; sending messages; registering
     callbacks; routing received messages to callbacks, commands, or do_default;
@@ -87,43 +180,122 @@ class WhispererBase:
         self.fname = fname
         self.user_callbacks: Dict[str, Callback] = {}
         # ...messages[timestamp][user] = msg
-        self.received_messages: Dict[int, Dict[str, Message]] = defaultdict(dict)
-        self.sent_messages: Dict[int, Dict[str, Message]] = defaultdict(dict)
-
-    # it's like this so it can be mocked out in tests
-    Popen = Popen
+        self.received_messages = BoundedTsMap(1000)
+        # reactions need these, so keep more of them around
+        self.sent_messages = BoundedTsMap(10000)
+        # commands for signal-cli that haven't been written yet
+        self.send_buffer: List[bytes] = []
+        # keeps references to running handle tasks so they aren't collected
+        self.handler_tasks: Set[asyncio.Task] = set()
 
     def __enter__(self) -> "WhispererBase":
         try:
-            user_names, followers, blocked = json.load(open(self.fname))
+            data = pathlib.Path(self.fname).read_bytes()
+            user_names, followers, blocked = orjson.loads(data)
         except FileNotFoundError:
             logging.info("didn't find saved user data")
             user_names, followers, blocked = [{}, {}, []]
         try:
-            self.admins = json.load(open("admins"))
+            admins = orjson.loads(pathlib.Path("admins").read_bytes())
         except FileNotFoundError:
-            self.admins = []
-        self.user_names = cast(bidict, {})  # tell pylint it's subscriptable
-        self.user_names = bidict(user_names)
-        self.followers = defaultdict(list, followers)
-        self.blocked: Set[str] = set(blocked)
+            admins = []
+        self.admins = frozenset(map(sys.intern, admins))
+        # numbers are interned, like Message.sender, so that comparing a
+        # sender against stored numbers can stop at an identity check
+        self.user_names: Dict[str, str] = {
+            sys.intern(number): name for number, name in user_names.items()
+        }
+        # inverse of user_names, kept in sync by set_name
+        self.user_numbers = {name: num for num, name in self.user_names.items()}
+        self.followers: Dict[str, Set[str]] = defaultdict(
+            set,
+            {
+                sys.intern(number): set(map(sys.intern, flist))
+                for number, flist in followers.items()
+            },
+        )
+        # inverse of followers: following[number] is who number follows
+        self.following: Dict[str, Set[str]] = defaultdict(set)
+        for number, number_followers in self.followers.items():
+            for follower in number_followers:
+                self.following[follower].add(number)
+        self.blocked: Set[str] = set(map(sys.intern, blocked))
+        # whether user data changed since it was last saved
+        self.dirty = False
+        # command name -> handler, so receive doesn't getattr every message
+        self.commands: Dict[str, Callable] = {
+            name[3:]: getattr(self, name)
+            for name in dir(self)
+            if name.startswith("do_")
+        }
+        # docstrings don't change, so /help [command] doesn't dedent each time
+        self.command_docs = {
+            name: dedent(handler.__doc__).strip()
+            for name, handler in self.commands.items()
+            if handler.__doc__
+        }
         self.attachments_dir = (
             pathlib.Path.home() / ".local/share/signal-cli/attachments"
         )
-        self.signal_proc = self.Popen(
-            SIGNAL_CLI, stdin=PIPE, stdout=PIPE, stderr=PIPE
-        )
-        logging.info("started signal-cli process")
+        # Message joins attachment ids onto this, which is cheaper than Paths
+        self.attachments_prefix = str(self.attachments_dir) + os.sep
         return self
 
     def __exit__(self, _: Any, value: Any, traceback: Any) -> None:
-        json.dump(
-            [dict(self.user_names), self.followers, list(self.blocked)],
-            open(self.fname, "w"),
-        )
+        self.save_user_data(self.dump_user_data())
         logging.info("dumped user data to %s", self.fname)
-        self.signal_proc.kill()
-        logging.info("killed signal-cli process")
+
+    def dump_user_data(self) -> bytes:
+        return orjson.dumps(
+            [
+                self.user_names,
+                {
+                    number: sorted(flist)
+                    for number, flist in self.followers.items()
+                },
+                sorted(self.blocked),
+            ]
+        )
+
+    def save_user_data(self, data: bytes) -> None:
+        """
+        writes to a temporary file first so a crash mid-write can't leave a
+        truncated users file behind
+        """
+        tmp_fname = self.fname + ".tmp"
+        with open(tmp_fname, "wb") as f:
+            f.write(data)
+        os.replace(tmp_fname, self.fname)
+
+    checkpoint_interval = 30
+
+    async def checkpoint(self) -> None:
+        """
+        saves user data every checkpoint_interval seconds if it changed, so
+        a crash doesn't lose everything since startup
+        """
+        loop = asyncio.get_running_loop()
+        while 1:
+            await asyncio.sleep(self.checkpoint_interval)
+            if self.dirty:
+                self.dirty = False
+                # serialize here, where handlers can't change things under us
+                data = self.dump_user_data()
+                save = loop.run_in_executor(None, self.save_user_data, data)
+                try:
+                    await asyncio.shield(save)
+                except asyncio.CancelledError:
+                    # run is stopping and __exit__ saves again. let this save
+                    # finish first so it can't replace that one afterwards
+                    await asyncio.wait([save])
+                    if save.exception():
+                        self.dirty = True
+                    raise
+                except OSError:
+                    logging.exception("couldn't checkpoint user data")
+                    self.dirty = True
+                    continue
+                logging.debug("checkpointed user data to %s", self.fname)
 
     def do_default(self, msg: Message) -> None:
         raise NotImplementedError
@@ -132,35 +304,66 @@ class WhispererBase:
         """
         /help [command]. see the documentation for command, or all commands
         """
-        if msg.arg1:
-            try:
-                doc = getattr(self, f"do_{msg.arg1}").__doc__
-                if doc:
-                    return dedent(doc).strip()
-                return f"{msg.arg1} isn't documented, sorry :("
-            except AttributeError:
-                return f"no such command '{msg.arg1}'"
-        else:
-            resp = "documented commands: " + ", ".join(
-                name[3:]
-                for name in dir(self)
-                if name.startswith("do_")
-                and not hasattr(getattr(self, name), "admin")
-            )
-        return resp
+        arg1 = msg.arg1
+        if arg1:
+            doc = self.command_docs.get(arg1)
+            if doc:
+                return doc
+            if arg1 not in self.commands:
+                return f"no such command '{arg1}'"
+            return f"{arg1} isn't documented, sorry :("
+        return self.help_listing
+
+    @cached_property
+    def help_listing(self) -> str:
+        """the reply to /help. commands don't change, so it's only built once"""
+        return "documented commands: " + ", ".join(
+            name
+            for name, handler in self.commands.items()
+            if not hasattr(handler, "admin")
+        )
 
     def do_name(self, msg: Message) -> str:
         """/name [name]. set or change your name"""
         name = msg.arg1
         if not isinstance(name, str):
             return "missing name argument. usage: /name [name]"
-        if name in self.user_names.inverse or name.endswith("proxied"):
+        # a name that's a number could later be claimed by that number's owner
+        if (
+            name in self.user_numbers
+            or name.endswith("proxied")
+            or parse_number(name)
+        ):
             return (
                 f"'{name}' is already taken, use /name to set a different name"
             )
-        self.user_names[msg.sender] = name
+        self.set_name(msg.sender, name)
         return f"other users will now see you as {name}"
 
+    def set_name(self, number: str, name: str) -> None:
+        """
+        sets number's name, replacing any previous name for that number.
+        raises ValueError if another number already has that name
+        """
+        owner = self.user_numbers.get(name)
+        if owner is not None and owner != number:
+            raise ValueError(f"{name} is already {owner}'s name")
+        if number in self.user_names:
+            self.user_numbers.pop(self.user_names[number], None)
+        self.user_names[number] = name
+        self.user_numbers[name] = number
+        self.dirty = True
+
+    def add_follower(self, number: str, follower: str) -> None:
+        self.followers[number].add(follower)
+        self.following[follower].add(number)
+        self.dirty = True
+
+    def remove_follower(self, number: str, follower: str) -> None:
+        self.followers[number].discard(follower)
+        self.following[follower].discard(number)
+        self.dirty = True
+
     def register_callback(
         self, user: str, prompt: str, callback: Callable
     ) -> None:
@@ -203,36 +406,61 @@ class WhispererBase:
         sends a message to recipient. if force is false, checks that the user
         hasn't blocked messages from whispr, and prompts new users for a name
         """
-        assert self.signal_proc.stdin
         if force or recipient not in self.blocked and message:
             if not force and recipient not in self.user_names:
-                self.user_names[recipient] = recipient
-                self.send(
+                self.set_name(recipient, recipient)
+                self.send_raw(
                     recipient,
                     "welcome to whispr, a social media that runs on signal. "
                     "text STOP or BLOCK to not receive messages. type /help "
                     "to view available commands.",
                 )
-                self.send(recipient, message)
+                self.send_raw(recipient, message, attachments)
                 self.register_callback(
                     recipient, "what would you like to be called?", self.do_name
                 )
             else:
-                command: Dict[str, Any] = dict(
-                    commandName="sendMessage",
-                    recipient=recipient,
-                    content=message,
-                )
-                if attachments:
-                    command["details"] = {"attachments": attachments}
-                self.signal_proc.stdin.write(
-                    json.dumps(command).encode("utf-8") + b"\n"
-                )
-                self.signal_proc.stdin.flush()
+                self.send_raw(recipient, message, attachments)
 
-    fib = [0, 1]
-    for i in range(20):
-        fib.append(fib[-2] + fib[-1])
+    def send_raw(
+        self,
+        recipient: str,
+        message: str,
+        attachments: Optional[List[str]] = None,
+    ) -> None:
+        """
+        queues a sendMessage command for signal-cli without any of the checks
+        that send does. it's written out by flush_sends
+        """
+        self.broadcast_raw((recipient,), message, attachments)
+
+    def broadcast_raw(
+        self,
+        recipients: Iterable[str],
+        message: str,
+        attachments: Optional[List[str]] = None,
+    ) -> None:
+        """
+        send_raw for several recipients. the message and attachments are the
+        same for everyone, so they're only encoded once
+        """
+        rest = b',"content":' + orjson.dumps(message)
+        if attachments:
+            rest += b',"details":' + orjson.dumps({"attachments": attachments})
+        rest += b"}\n"
+        for recipient in recipients:
+            self.send_buffer.append(
+                b'{"commandName":"sendMessage","recipient":'
+                + orjson.dumps(recipient)
+                + rest
+            )
+
+    def flush_sends(self) -> None:
+        """writes every queued command to signal-cli at once"""
+        assert self.signal_proc.stdin
+        if self.send_buffer:
+            self.signal_proc.stdin.write(b"".join(self.send_buffer))
+            self.send_buffer.clear()
 
     def receive_reaction(self, msg: Message) -> None:
         """
@@ -246,15 +474,19 @@ class WhispererBase:
         logging.debug("reaction from %s targeting %s", msg.sender, react.ts)
         self.received_messages[msg.ts][msg.sender] = msg
         # stylistic choice to have less indents
-        if react.author != SERVER_NUMBER or react.ts not in self.sent_messages:
+        if react.author != SERVER_NUMBER:
+            return
+        # .get doesn't add missing timestamps like indexing would
+        sent = self.sent_messages.get(react.ts)
+        target_msg = sent.get(msg.sender) if sent else None
+        if not target_msg:
             return
 
-        target_msg = self.sent_messages[react.ts][msg.sender]
         logging.debug("found target message %s", target_msg.text)
         target_msg.reactions[msg.sender_name] = react.emoji
         logging.debug("reactions: %s", repr(target_msg.reactions))
         count = len(target_msg.reactions)
-        if count not in self.fib:
+        if count not in FIB:
             return
 
         logging.debug("sending reaction notif")
@@ -271,69 +503,161 @@ class WhispererBase:
         dispatch a received message to a command handler or do_default,
         handling basic SMS-style compliance
         """
+        sender = msg.sender
         try:
-            self.received_messages[msg.ts][msg.sender] = msg
-            if msg.text.lower() in ("stop", "block"):
+            self.received_messages[msg.ts][sender] = msg
+            match = COMPLIANCE_KEYWORDS.fullmatch(msg.text)
+            keyword = match.group().lower() if match else None
+            if keyword in ("stop", "block"):
                 self.send(
-                    msg.sender,
+                    sender,
                     "i'll stop messaging you. "
                     "text START or UNBLOCK to resume texts",
                 )
-                self.blocked.add(msg.sender)
+                self.blocked.add(sender)
+                self.dirty = True
                 return
-            if msg.text.lower() in ("start", "unblock"):
-                if msg.sender in self.blocked:
-                    self.blocked.remove(msg.sender)
-                    self.send(msg.sender, "welcome back")
+            if keyword in ("start", "unblock"):
+                if sender in self.blocked:
+                    self.blocked.remove(sender)
+                    self.dirty = True
+                    self.send(sender, "welcome back")
                     return
-                self.send(msg.sender, "you weren't blocked")
+                self.send(sender, "you weren't blocked")
                 return
             logging.info(
                 "%s: %s says %s", msg.ts, msg.sender_name, msg.full_text
             )
-            if msg.sender in self.user_callbacks:
-                resp: Optional[str] = self.user_callbacks.pop(msg.sender)(msg)
-            elif msg.command:
-                if hasattr(self, f"do_{msg.command}"):
-                    resp = getattr(self, f"do_{msg.command}")(msg)
+            # one probe instead of a membership test and then a pop
+            callback = self.user_callbacks.pop(sender, None)
+            command = msg.command
+            if callback:
+                resp: Optional[str] = callback(msg)
+            elif command:
+                handler = self.commands.get(command)
+                if handler:
+                    resp = handler(msg)
                 else:
-                    resp = f"no such command '{msg.command}'"
+                    resp = f"no such command '{command}'"
             else:
                 resp = self.do_default(msg)  # type: ignore
             if resp is not None:
-                self.send(msg.sender, resp)
-        except:
-            self.send(
-                msg.sender,
-                "OOPSIE WOOPSIE!! Uwu We made a fucky wucky!!"
-                "A wittle fucko boingo! The code monkeys at our headquarters "
-                "are working VEWY HAWD to fix this!",
-                # source: https://knowyourmeme.com/memes/oopsie-woopsie
-            )
+                self.send(sender, resp)
+        except Exception:
+            # not KeyboardInterrupt/SystemExit, shutting down isn't the user's
+            # problem
+            self.send(sender, OOPSIE)
             raise
 
-    def run(self) -> None:
+    async def start_signal_cli(self) -> None:
+        self.signal_proc = await asyncio.create_subprocess_exec(
+            *SIGNAL_CLI, stdin=PIPE, stdout=PIPE, stderr=PIPE
+        )
+        logging.info("started signal-cli process")
+
+    async def handle(self, envelope: dict, slots: asyncio.Semaphore) -> None:
         """
-        repeatedly reads json envelopes from signal-cli and massages the fields
-        for receive_reaction and receive
+        parses envelope and routes it to receive_reaction or receive, then
+        writes out the replies in one go and waits for signal-cli to take them
         """
-        assert self.signal_proc.stdout
-        while 1:
-            line = self.signal_proc.stdout.readline().decode("utf-8")
-            if not line.startswith("{"):
-                logging.warning("signal-cli says: %s", line.strip())
-                continue
+        assert self.signal_proc.stdin
+        try:
+            # parsed here rather than in run, since how a message is split up
+            # depends on callbacks that the messages before it can register
+            try:
+                msg = Message(self, envelope)
+            except KeyError:
+                logging.warning("that wasn't a real datamessage")
+                return
             try:
-                logging.info(line.strip())
-                msg = Message(self, json.loads(line)["envelope"])
                 if msg.reaction:
                     self.receive_reaction(msg)
                 else:
                     self.receive(msg)
-            except KeyError:
-                logging.warning("that wasn't a real datamessage")
-            except json.JSONDecodeError:
-                logging.error("couldn't decode that")
+            except Exception:  # pylint: disable=broad-except
+                logging.exception("error handling %s", msg)
+            # let any other handlers that are ready queue their replies too,
+            # so a burst of messages is written out together. whichever
+            # handler gets here first writes everything. receive may have
+            # queued replies (like the oopsie) before failing, so always flush
+            await asyncio.sleep(0)
+            # only one drain can wait on a paused pipe at a time, so the rest
+            # queue here. whatever they add meanwhile goes out in one write
+            async with self.write_lock:
+                self.flush_sends()
+                await self.signal_proc.stdin.drain()
+        finally:
+            slots.release()
+
+    async def log_stderr(self) -> None:
+        """
+        log whatever signal-cli writes to stderr, so it never fills the pipe
+        """
+        assert self.signal_proc.stderr
+        while line := await self.signal_proc.stderr.readline():
+            logging.warning(
+                "signal-cli says: %s", line.decode(errors="replace").strip()
+            )
+
+    async def read_lines(self) -> AsyncIterator[bytes]:
+        """
+        yield lines from signal-cli's stdout, reading it in large chunks so
+        that a burst of envelopes is a single read instead of one per line
+        """
+        assert self.signal_proc.stdout
+        buffer = b""
+        while chunk := await self.signal_proc.stdout.read(65536):
+            *lines, buffer = (buffer + chunk).split(b"\n")
+            for line in lines:
+                if line:
+                    yield line
+        if buffer:
+            yield buffer
+
+    async def run(self) -> None:
+        """
+        starts signal-cli and reads json envelopes from it until it closes
+        stdout. each message is handled in its own task so reading doesn't
+        wait on handlers
+        """
+        await self.start_signal_cli()
+        assert self.signal_proc.stdout
+        # made here so it belongs to the running loop
+        self.write_lock = asyncio.Lock()
+        # at most 32 messages are handled at once
+        slots = asyncio.Semaphore(32)
+        checkpointer = asyncio.create_task(self.checkpoint())
+        stderr_logger = asyncio.create_task(self.log_stderr())
+        try:
+            async for line in self.read_lines():
+                # signal-cli logs to stderr, so stdout is all json
+                logging.info(line.decode().strip())
+                # most envelopes are receipts or typing notifications. don't
+                # bother decoding anything that can't have a message in it
+                if b'"dataMessage"' not in line:
+                    continue
+                try:
+                    envelope = orjson.loads(line).get("envelope", {})
+                except orjson.JSONDecodeError:
+                    logging.error("couldn't decode that")
+                    continue
+                if not envelope.get("dataMessage"):
+                    continue
+                await slots.acquire()
+                task = asyncio.create_task(self.handle(envelope, slots))
+                self.handler_tasks.add(task)
+                task.add_done_callback(self.handler_tasks.discard)
+            logging.warning("signal-cli closed stdout")
+            await asyncio.gather(*self.handler_tasks)
+        finally:
+            checkpointer.cancel()
+            stderr_logger.cancel()
+            # asyncio.run doesn't wait for executor jobs before 3.9, so wait
+            # for any save in progress here
+            await asyncio.wait([checkpointer])
+            if self.signal_proc.returncode is None:
+                self.signal_proc.kill()
+                logging.info("killed signal-cli process")
 
 
 # def register_command(command: Callable) -> Callable:
@@ -344,22 +668,38 @@ class WhispererBase:
 #     def __init__
 
 
+@lru_cache(maxsize=4096)
+def parse_number(number: str) -> Optional[str]:
+    """
+    returns number in E164 format, or None if it isn't a valid number.
+    phonenumbers is slow and people keep referring to the same numbers
+    """
+    try:
+        parsed = pn.parse(number, None)
+    except pn.phonenumberutil.NumberParseException:
+        return None
+    if not pn.is_valid_number(parsed):
+        return None
+    return pn.format_number(parsed, pn.PhoneNumberFormat.E164)
+
+
+@lru_cache(maxsize=256)
+def compile_debug(source: str) -> CodeType:
+    """compiles a /debug expression, so repeating one doesn't reparse it"""
+    return compile(source, "<debug>", "eval")
+
+
 def takes_number(command: Callable) -> Callable:
     @wraps(command)  # keeps original name and docstring for /help
     def wrapped_command(self: WhispererBase, msg: Message) -> str:
-        if msg.arg1 in self.user_names.inverse:
-            target_number = self.user_names.inverse[msg.arg1]
+        arg = msg.arg1 or ""
+        target_number = self.user_numbers.get(arg) or parse_number(arg)
+        if target_number:
             return command(self, msg, target_number)
-        try:
-            parsed = pn.parse(msg.arg1, None)
-            assert pn.is_valid_number(parsed)
-            target_number = pn.format_number(parsed, pn.PhoneNumberFormat.E164)
-            return command(self, msg, target_number)
-        except (pn.phonenumberutil.NumberParseException, AssertionError):
-            return (
-                f"{msg.arg1} doesn't look a valid number or user. "
-                "did you include the country code?"
-            )
+        return (
+            f"{msg.arg1} doesn't look a valid number or user. "
+            "did you include the country code?"
+        )
 
     return wrapped_command
 
@@ -387,14 +727,19 @@ class Whisperer(WhispererBase):
 
     def do_default(self, msg: Message) -> None:
         """send a message to your followers"""
-        if msg.sender not in self.user_names:
-            self.send(msg.sender, f"{msg.text} yourself")
+        sender = msg.sender
+        if sender not in self.user_names:
+            self.send(sender, f"{msg.text} yourself")
             # ensures they'll get a welcome message
         else:
-            name = self.user_names[msg.sender]
-            for follower in self.followers[msg.sender]:
-                self.sent_messages[round(time.time())][follower] = msg
-                self.send(follower, f"{name}: {msg.text}", msg.attachments)
+            text = f"{self.user_names[sender]}: {msg.text}"
+            sent = self.sent_messages[int(time.time())]
+            # followers have all been welcomed already, so the only check
+            # send would do that matters here is whether they blocked us
+            followers = self.followers[sender] - self.blocked
+            for follower in followers:
+                sent[follower] = msg
+            self.broadcast_raw(followers, text, msg.attachments)
             # ideally react to the message indicating it was sent?
 
     do_echo = staticmethod(do_echo)
@@ -402,37 +747,39 @@ class Whisperer(WhispererBase):
     @takes_number
     def do_follow(self, msg: Message, target_number: str) -> str:
         """/follow [number or name]. follow someone"""
-        if msg.sender not in self.followers[target_number]:
+        sender, arg1 = msg.sender, msg.arg1
+        if sender not in self.followers[target_number]:
             self.send(target_number, f"{msg.sender_name} has followed you")
-            self.followers[target_number].append(msg.sender)
+            self.add_follower(target_number, sender)
             # offer to follow back?
-            return f"followed {msg.arg1}"
-        return f"you're already following {msg.arg1}"
+            return f"followed {arg1}"
+        return f"you're already following {arg1}"
 
     @takes_number
     def do_invite(self, msg: Message, target_number: str) -> str:
         """
         /invite [number or name]. invite someone to follow you
         """
-        if target_number not in self.followers[msg.sender]:
+        sender, arg1 = msg.sender, msg.arg1
+        if target_number not in self.followers[sender]:
             self.register_callback(
                 target_number,
                 f"{msg.sender_name} invited you to follow them on whispr. "
                 "text (y)es or (n)o to accept",
-                self.create_response_callback(msg.sender),
+                self.create_response_callback(sender),
             )
-            return f"invited {msg.arg1}"
-        return f"you're already following {msg.arg1}"
+            return f"invited {arg1}"
+        return f"you're already following {arg1}"
 
     def create_response_callback(self, inviter: str) -> Callback:
         inviter_name = self.user_names[inviter]
 
         def response_callback(msg: Message) -> str:
-            response = msg.text.lower()
-            if response in "yes":  # matches substrings!
-                self.followers[inviter].append(msg.sender)
+            response = msg.text.strip().lower()
+            if response in YES:
+                self.add_follower(inviter, msg.sender)
                 return f"followed {inviter_name}"
-            if response in "no":
+            if response in NO:
                 return f"didn't follow {inviter_name}"
             return (
                 "that didn't look like a response. "
@@ -448,17 +795,18 @@ class Whisperer(WhispererBase):
         sender = msg.sender
         if sender in self.followers and self.followers[sender]:
             return ", ".join(
-                self.user_names[number] for number in self.followers[sender]
+                sorted(
+                    self.user_names[number] for number in self.followers[sender]
+                )
             )
         return "you don't have any followers"
 
     def do_following(self, msg: Message) -> str:
         """/following. list who you follow"""
-        sender = msg.sender
         following = ", ".join(
-            self.user_names[number]
-            for number, followers in self.followers.items()
-            if sender in followers
+            sorted(
+                self.user_names[number] for number in self.following[msg.sender]
+            )
         )
         if not following:
             return "you aren't following anyone"
@@ -467,18 +815,20 @@ class Whisperer(WhispererBase):
     @takes_number
     def do_softblock(self, msg: Message, target_number: str) -> str:
         """/softblock [number or name]. removes someone from your followers"""
-        if target_number not in self.followers[msg.sender]:
-            return f"{msg.arg1} isn't following you"
-        self.followers[msg.sender].remove(target_number)
-        return f"softblocked {msg.arg1}"
+        sender, arg1 = msg.sender, msg.arg1
+        if target_number not in self.followers[sender]:
+            return f"{arg1} isn't following you"
+        self.remove_follower(sender, target_number)
+        return f"softblocked {arg1}"
 
     @takes_number
     def do_unfollow(self, msg: Message, target_number: str) -> str:
         """/unfollow [target_number or name]. unfollow someone"""
-        if msg.sender not in self.followers[target_number]:
-            return f"you aren't following {msg.arg1}"
-        self.followers[target_number].remove(msg.sender)
-        return f"unfollowed {msg.arg1}"
+        sender, arg1 = msg.sender, msg.arg1
+        if sender not in self.followers[target_number]:
+            return f"you aren't following {arg1}"
+        self.remove_follower(target_number, sender)
+        return f"unfollowed {arg1}"
 
     @admin
     def do_proxy(self, msg: Message) -> str:
@@ -491,7 +841,7 @@ class Whisperer(WhispererBase):
         proxied = msg.sender
         # should be caught by the callback, but can fail on server restart
         assert not proxied_name.endswith("proxied")
-        self.user_names[proxied] = proxied_name + "proxied"
+        self.set_name(proxied, proxied_name + "proxied")
 
         def response_callback(msg: Message) -> None:
             """
@@ -511,7 +861,7 @@ class Whisperer(WhispererBase):
             recipients' responses will be sent back to the proxied user
             """
             if msg.text.startswith("/proxy"):
-                self.user_names[proxied] = proxied_name
+                self.set_name(proxied, proxied_name)
                 return "exited proxy mode"
             target, proxied_message = msg.text.split(":", 1)
             self.send(target, proxied_message, msg.attachments, force=True)
@@ -527,7 +877,10 @@ class Whisperer(WhispererBase):
     @admin
     def do_debug(self, msg: Message) -> str:  # pylint: disable=no-self-use
         try:
-            return str(eval(msg.text))  # pylint: disable=eval-used
+            code = compile_debug(msg.text)
+            return str(
+                eval(code, globals(), locals())  # pylint: disable=eval-used
+            )
         except Exception as e:  # pylint: disable=broad-except
             return str(e)
 
@@ -536,7 +889,7 @@ class Whisperer(WhispererBase):
     def do_forceinvite(self, msg: Message, target_number: str) -> str:
         if target_number in self.followers[msg.sender]:
             return f"{msg.arg1} is already following you"
-        self.followers[msg.sender].append(target_number)
+        self.add_follower(msg.sender, target_number)
         self.send(target_number, f"you are now following {msg.sender_name}")
         return f"{msg.arg1} is now following you"
 
@@ -547,4 +900,4 @@ class Whisperer(WhispererBase):
 
 if __name__ == "__main__":
     with Whisperer() as whisperer:
-        whisperer.run()
+        asyncio.run(whisperer.run())